@@ -8,14 +8,20 @@ Simple AI Server
 
 import os
 import json
+import asyncio
+import logging
 import re
 import csv
-from typing import Dict, Any, Optional
+import io
+from contextlib import asynccontextmanager
+from typing import Dict, Any, Optional, Set
 
 import httpx
+import msgspec
+import orjson
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response
 from dotenv import load_dotenv, find_dotenv
 
 # --- Environment Setup ---
@@ -28,19 +34,76 @@ OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 OPENAI_URL = "https://api.openai.com/v1/chat/completions"
 OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
 
+# Model families that take `max_completion_tokens` instead of `max_tokens`
+_MAX_COMPLETION_TOKENS_PREFIXES = ("gpt-5", "o1", "o3", "o4")
+
+# Patterns used to clean up LLM output (compiled once at import)
+_FENCE_RE = re.compile(r"^```[a-zA-Z0-9]*\n?|\n?```$")
+_SMART_QUOTES = str.maketrans({"\u201c": '"', "\u201d": '"', "\u2019": "'"})
+_DECODER = json.JSONDecoder()
+
+# CSV output for /v1/prefill (rows are queued and appended in batches)
+CSV_PATH = "data.csv"
+CSV_FIELDS = ("amount", "currency", "due_date", "description", "company", "contact")
+CSV_BATCH_SIZE = 100
+CSV_FLUSH_INTERVAL_MS = 50
+CSV_QUEUE_MAXSIZE = 10_000  # bounds memory; prefill waits when the writer falls behind
+
+# Paths whose header has already been checked/written by this process
+_csv_header_written: Set[str] = set()
+
+logger = logging.getLogger(__name__)
+
+
+# --- App Lifecycle ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Share one pooled HTTP/2 client across all requests so upstream
+    connections (TCP + TLS) are kept alive and concurrent calls are
+    multiplexed over them, and run the background CSV writer for /v1/prefill.
+    """
+    app.state.http_client = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(60.0),
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=30),
+    )
+    app.state.csv_queue = asyncio.Queue(maxsize=CSV_QUEUE_MAXSIZE)
+    csv_writer = asyncio.create_task(csv_writer_loop(app.state.csv_queue))
+    try:
+        yield
+    finally:
+        try:
+            # Drain pending rows before exiting
+            await app.state.csv_queue.put(None)
+            await csv_writer
+        finally:
+            await app.state.http_client.aclose()
+
+
 # Create FastAPI app
-app = FastAPI(title="AI Server", version="1.0.0")
+app = FastAPI(
+    title="AI Server",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+
+# Compress larger responses (e.g. chat completions) for clients that accept gzip
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
 
 # ---------- Helpers ----------
 def normalize_for_gpt5(body: dict) -> dict:
     """
-    Some GPT-5 models use `max_completion_tokens` instead of `max_tokens`.
+    gpt-5*, o1*, o3* and o4* models use `max_completion_tokens` instead of `max_tokens`
+    (see _MAX_COMPLETION_TOKENS_PREFIXES).
     This function ensures compatibility by renaming the parameter if needed.
+    The dict is modified in place, so callers must pass one they own
+    (e.g. freshly parsed from the request).
     """
     model = body.get("model", "")
-    if model.startswith("gpt-5") and "max_tokens" in body and "max_completion_tokens" not in body:
-        body = dict(body)
+    if model.startswith(_MAX_COMPLETION_TOKENS_PREFIXES) and "max_tokens" in body and "max_completion_tokens" not in body:
         body["max_completion_tokens"] = body.pop("max_tokens")
     return body
 
@@ -50,11 +113,12 @@ def is_openrouter_model(model: str) -> bool:
     Identify whether the given model string refers to an OpenRouter model.
     Convention: contains "/" or ends with ":free"
     Example: "qwen/qwen3-235b-a22b:free"
+    OpenAI "gpt-*" names are ruled out by a single prefix check.
     """
-    return "/" in model or model.endswith(":free")
+    return not model.startswith("gpt-") and ("/" in model or model.endswith(":free"))
 
 
-async def forward_to_upstream(body: dict) -> httpx.Response:
+async def forward_to_upstream(request: Request, body: dict) -> httpx.Response:
     """
     Forward request to the correct upstream provider:
       - OpenAI if model is gpt-* 
@@ -76,22 +140,93 @@ async def forward_to_upstream(body: dict) -> httpx.Response:
         headers["Authorization"] = f"Bearer {OPENAI_API_KEY}"
         upstream_url = OPENAI_URL
 
-    # Forward the request to the appropriate provider
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        return await client.post(upstream_url, headers=headers, json=body)
+    # Forward the request to the appropriate provider (shared client, see lifespan)
+    return await request.app.state.http_client.post(upstream_url, headers=headers, json=body)
 
 
 def ensure_csv_header(path: str, fieldnames):
     """
     Ensure that the CSV file exists and has the correct header row.
-    If the file is new/empty, write the header.
+    The file is created with O_EXCL, so when several workers start on a
+    missing file exactly one of them creates it and writes the header.
+    An existing file is assumed to have its header already (delete the
+    file, rather than emptying it, to start over).
+    The check only touches the filesystem once per path per process.
     """
+    if path in _csv_header_written:
+        return
     os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
-    need_header = not os.path.exists(path) or os.path.getsize(path) == 0
-    if need_header:
-        with open(path, "w", newline="", encoding="utf-8") as f:
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        pass
+    else:
+        with open(fd, "w", newline="", encoding="utf-8") as f:
             writer = csv.DictWriter(f, fieldnames=fieldnames)
             writer.writeheader()
+    _csv_header_written.add(path)
+
+
+def write_csv_rows(path: str, fieldnames, rows) -> None:
+    """
+    Append a batch of records to the CSV with a single open/write.
+    Rows are formatted in memory and appended with one unbuffered O_APPEND
+    write(), which keeps batches from several workers sharing the file from
+    interleaving on local filesystems (not guaranteed on network mounts).
+    """
+    ensure_csv_header(path, fieldnames)
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=fieldnames)
+    lines = []
+    for row in rows:
+        writer.writerow(row)
+        line = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        try:
+            lines.append(line.encode("utf-8"))
+        except UnicodeEncodeError:
+            logger.warning("Dropping CSV row that cannot be encoded as UTF-8: %r", row)
+    if not lines:
+        return
+    with open(path, "ab", buffering=0) as f:
+        f.write(b"".join(lines))
+
+
+async def csv_writer_loop(queue: asyncio.Queue) -> None:
+    """
+    Background task that drains queued records into the CSV.
+    Collects up to CSV_BATCH_SIZE rows (or whatever arrives within
+    CSV_FLUSH_INTERVAL_MS), then writes them off the event loop.
+    A None sentinel flushes the current batch and stops the loop.
+    A failed batch is logged and dropped; the loop keeps running.
+    """
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        record = await queue.get()
+        if record is None:
+            break
+
+        batch = [record]
+        deadline = loop.time() + CSV_FLUSH_INTERVAL_MS / 1000
+        while len(batch) < CSV_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                record = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if record is None:
+                stopping = True
+                break
+            batch.append(record)
+
+        try:
+            await asyncio.to_thread(write_csv_rows, CSV_PATH, CSV_FIELDS, batch)
+        except Exception:
+            logger.exception("Failed to write %d row(s) to %s", len(batch), CSV_PATH)
 
 
 def _strip_code_fences(text: str) -> str:
@@ -99,62 +234,37 @@ def _strip_code_fences(text: str) -> str:
     Remove Markdown code fences from LLM responses if present.
     Example: ```json {...} ``` → {...}
     """
-    text = text.strip()
-    if text.startswith("```"):
-        lines = text.splitlines()
-        if lines and lines[0].startswith("```"):
-            lines = lines[1:]
-        if lines and lines[-1].strip().startswith("```"):
-            lines = lines[:-1]
-        text = "\n".join(lines).strip()
-    return text
+    return _FENCE_RE.sub("", text.strip()).strip()
 
 
 def safe_json_from_text(text: str) -> Dict[str, Any]:
     """
     Robust JSON extractor for LLM responses.
     Tries multiple strategies:
-      1. Direct json.loads()
-      2. Greedy {...} regex match
-      3. Stack-based balanced braces
+      1. Direct orjson.loads() on the raw response (the common case)
+      2. Strip code fences / smart quotes, then raw_decode() from the first "{"
+         (ignores any trailing text after the object)
     Raises ValueError if parsing fails.
     """
-    if text is None:
-        raise ValueError("Empty model response")
-
-    text = _strip_code_fences(text)
-    text = text.replace("“", '"').replace("”", '"').replace("’", "'")
-
     # Attempt direct load
     try:
-        return json.loads(text)
-    except Exception:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
         pass
 
-    # Regex greedy parse
-    m = re.search(r"\{.*\}", text, flags=re.DOTALL)
-    if m:
-        candidate = m.group(0)
-        try:
-            return json.loads(candidate)
-        except Exception:
-            pass
+    text = _strip_code_fences(text)
+    text = text.translate(_SMART_QUOTES)
 
-    # Stack-based brace parsing
+    # Decode the first object, stopping at its matching brace (C scanner,
+    # so braces inside string values are handled correctly)
     start = text.find("{")
-    if start != -1:
-        depth = 0
-        for i, ch in enumerate(text[start:], start=start):
-            if ch == "{":
-                depth += 1
-            elif ch == "}":
-                depth -= 1
-                if depth == 0:
-                    candidate = text[start:i + 1]
-                    try:
-                        return json.loads(candidate)
-                    except Exception:
-                        break
+    end = text.rfind("}")
+    if start != -1 and end > start:
+        try:
+            obj, _ = _DECODER.raw_decode(text, start)
+            return obj
+        except json.JSONDecodeError:
+            pass
 
     raise ValueError("Could not parse JSON from model response")
 
@@ -164,16 +274,7 @@ def canonicalize_record(d: Dict[str, Any]) -> Dict[str, str]:
     Ensure extracted invoice record has all required fields
     and that all values are strings.
     """
-    fields = ["amount", "currency", "due_date", "description", "company", "contact"]
-    out: Dict[str, str] = {}
-    for k in fields:
-        v = d.get(k, "")
-        if v is None:
-            v = ""
-        if k == "amount" and isinstance(v, (int, float)):
-            v = str(v)
-        out[k] = str(v).strip()
-    return out
+    return {k: "" if (v := d.get(k)) is None else str(v).strip() for k in CSV_FIELDS}
 
 
 # ---------- Endpoint: Chat Completions ----------
@@ -189,18 +290,22 @@ async def chat_completions(request: Request):
     if "model" not in body or "messages" not in body:
         raise HTTPException(status_code=400, detail="Fields 'model' and 'messages' are required")
 
-    # Compatibility shim for gpt-5*
+    # Compatibility shim for models that require max_completion_tokens
     body = normalize_for_gpt5(body)
     # print("Using model:", body.get("model", ""))           #print which model is running
 
     try:
-        upstream = await forward_to_upstream(body)
+        upstream = await forward_to_upstream(request, body)
+
+        # Pass successful responses through as raw bytes (no decode/re-encode)
+        if upstream.status_code == 200:
+            return Response(content=upstream.content, media_type="application/json")
 
-        # Try to parse and return JSON
+        # Relay provider errors as JSON when possible
         try:
-            data = upstream.json()
-            return JSONResponse(status_code=upstream.status_code, content=data)
-        except json.JSONDecodeError:
+            data = orjson.loads(upstream.content)
+            return ORJSONResponse(status_code=upstream.status_code, content=data)
+        except orjson.JSONDecodeError:
             # If provider didn’t return JSON
             raise HTTPException(status_code=upstream.status_code, detail=upstream.text)
 
@@ -209,21 +314,29 @@ async def chat_completions(request: Request):
 
 
 # ---------- Endpoint: Prefill ----------
-class PrefillIn(BaseModel):
+class PrefillIn(msgspec.Struct):
     """Request schema for /v1/prefill"""
     email_text: str
     model: Optional[str] = None
 
 
 @app.post("/v1/prefill")
-async def prefill(payload: PrefillIn):
+async def prefill(request: Request):
     """
     Extract billing fields (amount, currency, due_date, description, company, contact)
     from a raw email using an LLM, then save results into data.csv.
     """
-    email_text = (payload.email_text or "").strip()
+    try:
+        payload = msgspec.json.decode(await request.body(), type=PrefillIn)
+    except msgspec.DecodeError as e:
+        return ORJSONResponse(
+            status_code=422,
+            content={"success": False, "message": f"invalid request body: {e}"},
+        )
+
+    email_text = payload.email_text.strip()
     if not email_text:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=400,
             content={"success": False, "message": "email_text is required"},
         )
@@ -264,44 +377,38 @@ async def prefill(payload: PrefillIn):
         "response_format": {"type": "json_object"},
         "max_completion_tokens": 1000,
     }
-    body = normalize_for_gpt5(body)
 
     try:
-        upstream = await forward_to_upstream(body)
+        upstream = await forward_to_upstream(request, body)
 
         if upstream.status_code != 200:
-            return JSONResponse(
+            return ORJSONResponse(
                 status_code=upstream.status_code,
                 content={"success": False, "message": "something went wrong"},
             )
 
-        resp = upstream.json()
-        raw_text = resp["choices"][0]["message"]["content"]
+        resp = orjson.loads(upstream.content)
+        raw_text = resp["choices"][0]["message"]["content"] or ""
 
         # Parse the JSON safely
         try:
             parsed = safe_json_from_text(raw_text)
-        except Exception:
-            return JSONResponse(
+        except ValueError:
+            return ORJSONResponse(
                 status_code=502,
                 content={"success": False, "message": "something went wrong"},
             )
 
         record = canonicalize_record(parsed)
 
-        # Save record to CSV
-        csv_path = "data.csv"
-        fields = ["amount", "currency", "due_date", "description", "company", "contact"]
-        ensure_csv_header(csv_path, fields)
-        with open(csv_path, "a", newline="", encoding="utf-8") as f:
-            writer = csv.DictWriter(f, fieldnames=fields)
-            writer.writerow(record)
+        # Queue record for the background CSV writer (written asynchronously)
+        await request.app.state.csv_queue.put(record)
 
         # Response matches README
-        return {"success": True, "message": "data extracted and written"}
+        return {"success": True, "message": "data extracted"}
 
     except httpx.HTTPError:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=502,
             content={"success": False, "message": "something went wrong"},
         )